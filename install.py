@@ -1,12 +1,22 @@
 import os
+import sys
 from pathlib import Path
 from getpass import getpass
 import subprocess
 import shutil
-import time
+import shlex
 import re
 import json
 
+# Fail fast before importing archinstall, whose device handler probes every
+# block device as soon as it is imported
+if os.geteuid() != 0:
+    raise SystemExit("Error: This script must be run as root.")
+
+# Check for UEFI mode
+if not os.path.exists('/sys/firmware/efi'):
+    raise SystemExit("Error: This script requires a UEFI system. BIOS systems are not supported.")
+
 from archinstall.default_profiles.minimal import MinimalProfile
 from archinstall.lib.disk.device_handler import device_handler
 from archinstall.lib.disk.filesystem import FilesystemHandler
@@ -39,7 +49,8 @@ DEFAULT_CONFIG = {
     "timezone": "Europe/Oslo",
     "swap_size": "8G",
     "pacman_mirror": "192.168.1.100",
-    "aur_mirror": "192.168.1.100"
+    "aur_mirror": "192.168.1.100",
+    "disk_encryption": True
 }
 
 def load_config():
@@ -58,53 +69,110 @@ def load_config():
 
 config = load_config()
 
-# Check for UEFI mode
-if not os.path.exists('/sys/firmware/efi'):
-    raise SystemExit("Error: This script requires a UEFI system. BIOS systems are not supported.")
+# LUKS1 and LUKS2 headers both start with this magic and store the UUID at bytes 168-208
+LUKS_MAGIC = b'LUKS\xba\xbe'
+
+def blkid_uuid(dev_path):
+    """Read the filesystem UUID of dev_path with blkid."""
+    return subprocess.check_output(['blkid', '-s', 'UUID', '-o', 'value', dev_path]).decode().strip()
+
+def luks_uuid(dev_path):
+    """Read the UUID from a LUKS header on dev_path, falling back to blkid."""
+    with open(dev_path, 'rb') as f:
+        header = f.read(208)
+    if header[:6] == LUKS_MAGIC:
+        return header[168:208].rstrip(b'\0').decode()
+    return blkid_uuid(dev_path)
+
+def is_rotational(dev_path):
+    """Return whether a whole-disk block device reports itself as rotational (unknown counts as rotational)."""
+    try:
+        return Path('/sys/block', Path(dev_path).name, 'queue', 'rotational').read_text().strip() != '0'
+    except OSError:
+        return True
 
 # Custom input function to provide default values
 def input_with_default(prompt, default):
     user_input = input(f"{prompt} [{default}]: ")
     return user_input.strip() or default
 
+# Plain terminal yes/no prompt; an empty answer selects the default
+def input_yes_no(prompt, default=False):
+    hint = "Y/n" if default else "y/N"
+    user_input = input(f"{prompt} [{hint}]: ").strip().lower()
+    if not user_input:
+        return default
+    return user_input.startswith('y')
+
+def write_files(files):
+    """Write (path, content) pairs, creating each distinct parent directory once."""
+    for parent in {path.parent for path, _ in files}:
+        parent.mkdir(parents=True, exist_ok=True)
+    for path, content in files:
+        path.write_text(content)
+
+def copy_tree(source, target):
+    """Copy a directory tree into target, preferring cp -a so the copy runs in C and can reflink."""
+    target.mkdir(parents=True, exist_ok=True)
+    if shutil.which('cp'):
+        subprocess.run(['cp', '-a', '--reflink=auto', f'{source}/.', target], check=True)
+    else:
+        shutil.copytree(source, target, dirs_exist_ok=True)
+
 # Get the list of available devices
 devices = device_handler.devices
 if not devices:
     raise ValueError("No devices found")
 
+# ARCHINSTALL_DEVICE skips the device prompt, e.g. ARCHINSTALL_DEVICE=/dev/nvme0n1
+preselected_device = os.environ.get('ARCHINSTALL_DEVICE')
+if preselected_device:
+    selected_device = next((d for d in devices if str(d.device_info.path) == preselected_device), None)
+    if selected_device is None:
+        raise SystemExit(f"Error: ARCHINSTALL_DEVICE={preselected_device} is not an available device.")
+    print(f"Using preselected device: {preselected_device}")
 # Automatically select the device if there is only one
-if len(devices) == 1:
+elif len(devices) == 1:
     selected_device = devices[0]
-    print(f"Only one device found: {selected_device.device_info.path} - {selected_device.device_info.total_size.format_highest()}")
+    info = selected_device.device_info
+    print(f"Only one device found: {info.path} - {info.total_size.format_highest()}")
 else:
-    # Display available devices with numbers and sizes
+    # Display available devices with numbers and sizes, formatted once
+    choices = {}
     print("Available devices:")
     for i, device in enumerate(devices, start=1):
-        size_gib = device.device_info.total_size.format_highest()
-        print(f"{i}. {device.device_info.path} - {size_gib}")
+        info = device.device_info
+        size_gib = info.total_size.format_highest()
+        print(f"{i}. {info.path} - {size_gib}")
+        choices[str(i)] = device
 
     # Prompt the user to select a device by number
     while True:
-        try:
-            choice = int(input("Enter the number of the device to use: "))
-            if 1 <= choice <= len(devices):
-                selected_device = devices[choice - 1]
-                break
-            else:
-                print("Invalid number. Please try again.")
-        except ValueError:
-            print("Please enter a valid number.")
-
-# Use the selected device
+        choice = input("Enter the number of the device to use: ").strip()
+        if choice in choices:
+            selected_device = choices[choice]
+            break
+        print("Invalid number. Please try again.")
+
+# Use the selected device and read its geometry once
 device = selected_device
+device_info = device.device_info
+sector_size = device_info.sector_size
 
 # Prompt user for installation inputs with defaults from config
-hostname = input_with_default("Enter hostname", config["hostname"])
-sudo_user = input_with_default("Enter sudo user username", config["username"])
-use_local_mirrors = input_with_default("Use local offline mirrors for pacman and AUR?", "No").lower().startswith('y')
-sudo_password = getpass("Enter sudo user password: ")
-root_password = getpass("Enter root password: ")
-encryption_password = getpass("Enter disk encryption password: ")
+# ARCHINSTALL_HOSTNAME and ARCHINSTALL_USERNAME skip the prompts when set
+hostname = os.environ.get('ARCHINSTALL_HOSTNAME') or input_with_default("Enter hostname", config["hostname"])
+sudo_user = os.environ.get('ARCHINSTALL_USERNAME') or input_with_default("Enter sudo user username", config["username"])
+use_local_mirrors = input_yes_no("Use local offline mirrors for pacman and AUR?")
+# Disk encryption can be turned off in config.json for performance builds
+use_encryption = config["disk_encryption"]
+if not isinstance(use_encryption, bool):
+    raise SystemExit(f"Error: disk_encryption in configuration must be true or false, got {use_encryption!r}.")
+# Passwords are wrapped once and the Password objects reused below
+sudo_password = Password(plaintext=getpass("Enter sudo user password: "))
+root_password = Password(plaintext=getpass("Enter root password: "))
+if use_encryption:
+    encryption_password = Password(plaintext=getpass("Enter disk encryption password: "))
 
 # Create device modification with wipe
 device_modification = DeviceModification(device, wipe=True)
@@ -113,11 +181,21 @@ device_modification = DeviceModification(device, wipe=True)
 fs_type = FilesystemType('ext4')
 
 # Get total disk size as a Size object
-total_disk_size = device.device_info.total_size
+total_disk_size = device_info.total_size
+
+# Partition geometry is worked out in whole MiB; Size objects are only
+# built when handed to archinstall
+def mib(value):
+    return Size(value, Unit.MiB, sector_size)
+
+boot_start_mib = 1
+boot_length_mib = 1024
+root_start_mib = boot_start_mib + boot_length_mib
+end_gap_mib = 1
 
 # Create EFI System Partition (FAT32, 1024 MiB, mounted at /boot)
-boot_start = Size(1, Unit.MiB, device.device_info.sector_size)
-boot_length = Size(1024, Unit.MiB, device.device_info.sector_size)
+boot_start = mib(boot_start_mib)
+boot_length = mib(boot_length_mib)
 boot_partition = PartitionModification(
     status=ModificationStatus.Create,
     type=PartitionType.Primary,
@@ -130,8 +208,8 @@ boot_partition = PartitionModification(
 device_modification.add_partition(boot_partition)
 
 # Create root partition (ext4, remaining space)
-root_start = boot_start + boot_length
-root_length = total_disk_size - root_start - Size(1, Unit.MiB, device.device_info.sector_size)
+root_start = mib(root_start_mib)
+root_length = total_disk_size - mib(root_start_mib + end_gap_mib)
 root_partition = PartitionModification(
     status=ModificationStatus.Create,
     type=PartitionType.Primary,
@@ -150,33 +228,42 @@ disk_config = DiskLayoutConfiguration(
 )
 
 # Configure disk encryption for root partition
-disk_encryption = DiskEncryption(
-    encryption_password=Password(plaintext=encryption_password),
-    encryption_type=EncryptionType.Luks,
-    partitions=[root_partition],
-    hsm_device=None,
-)
-disk_config.disk_encryption = disk_encryption
+if use_encryption:
+    disk_encryption = DiskEncryption(
+        encryption_password=encryption_password,
+        encryption_type=EncryptionType.Luks,
+        partitions=[root_partition],
+        hsm_device=None,
+    )
+    disk_config.disk_encryption = disk_encryption
 
 # Perform filesystem operations
 fs_handler = FilesystemHandler(disk_config)
 fs_handler.perform_filesystem_operations(show_countdown=False)
 
-# Get UUID of the encrypted root partition
-encrypted_uuid = subprocess.check_output(['blkid', '-s', 'UUID', '-o', 'value', root_partition.dev_path]).decode().strip()
+# Get UUID of the root partition (the LUKS container when encrypted)
+if use_encryption:
+    root_uuid = luks_uuid(root_partition.dev_path)
+else:
+    root_uuid = blkid_uuid(root_partition.dev_path)
+
+# Kernel root arguments and the initramfs hook needed to unlock the root partition
+if use_encryption:
+    root_cmdline = f'cryptdevice=UUID={root_uuid}:cryptroot root=/dev/mapper/cryptroot'
+    encrypt_hook = ' encrypt'
+else:
+    root_cmdline = f'root=UUID={root_uuid}'
+    encrypt_hook = ''
 
 # Define mountpoint
 mountpoint = Path('/mnt')
 
-# Detect GPU driver for early KMS
-lspci_output = subprocess.check_output(['lspci']).decode().lower()
-driver = None
-if 'intel' in lspci_output and 'vga' in lspci_output:
-    driver = 'i915'
-elif ('amd' in lspci_output or 'ati' in lspci_output) and 'vga' in lspci_output:
-    driver = 'amdgpu'
-elif 'nvidia' in lspci_output and 'vga' in lspci_output:
-    driver = 'nouveau'
+# Detect GPU driver for early KMS from the PCI vendor IDs of VGA controllers
+# (class 0300), in order of preference: Intel, AMD, NVIDIA
+GPU_DRIVERS = {'8086': 'i915', '1002': 'amdgpu', '10de': 'nouveau'}
+lspci_output = subprocess.check_output(['lspci', '-n', '-mm', '-d', '::0300'], text=True)
+gpu_vendors = {shlex.split(line)[2] for line in lspci_output.splitlines() if line}
+driver = next((GPU_DRIVERS[vendor] for vendor in GPU_DRIVERS if vendor in gpu_vendors), None)
 
 # Perform the installation
 with Installer(
@@ -189,6 +276,18 @@ with Installer(
     # directories like /mnt/boot as needed.
     installation.mount_ordered_layout()
 
+    # On SSD/NVMe, store the dm-crypt read/write workqueue bypass flags in the LUKS2 header
+    # while the root is open, so they apply whether the encrypt hook or clevis unlocks it
+    if use_encryption and not is_rotational(device_info.path):
+        lsblk_output = subprocess.check_output(['lsblk', '-lno', 'NAME,TYPE', root_partition.dev_path], text=True)
+        crypt_mapping = next(name for name, dev_type in (line.split() for line in lsblk_output.splitlines()) if dev_type == 'crypt')
+        subprocess.run(
+            ['cryptsetup', 'refresh', '--persistent', '--perf-no_read_workqueue', '--perf-no_write_workqueue', '--key-file=-', crypt_mapping],
+            input=encryption_password.plaintext,
+            text=True,
+            check=True,
+        )
+
     # Configure local mirrors for pacman if selected
     # Note: [community] repo was merged into [extra] in 2023
     if use_local_mirrors:
@@ -199,6 +298,7 @@ with Installer(
 HoldPkg     = pacman glibc
 Architecture = auto
 CheckSpace
+ParallelDownloads = 8
 SigLevel    = Required DatabaseOptional
 LocalFileSigLevel = Optional
 
@@ -226,18 +326,11 @@ SkipReview
 Server = http://{config["aur_mirror"]}/aur
 ''')
 
-    # Configure kernel cmdline for encryption
-    cmdline_path = mountpoint / 'etc' / 'kernel' / 'cmdline'
-    cmdline_path.parent.mkdir(parents=True, exist_ok=True)
-    with open(cmdline_path, 'w') as f:
-        f.write(f'cryptdevice=UUID={encrypted_uuid}:cryptroot root=/dev/mapper/cryptroot rw quiet splash loglevel=3 rd.udev.log_priority=3 vt.global_cursor_default=0 plymouth.use-simpledrm\n')
-
-    # Configure mkinitcpio preset for UKI
-    preset_dir = mountpoint / 'etc' / 'mkinitcpio.d'
-    preset_dir.mkdir(parents=True, exist_ok=True)
-    preset_path = preset_dir / 'linux.preset'
-    with open(preset_path, 'w') as f:
-        f.write('''
+    # Configure kernel cmdline and the mkinitcpio preset for UKI
+    write_files([
+        (mountpoint / 'etc' / 'kernel' / 'cmdline',
+         f'{root_cmdline} rw quiet splash loglevel=3 rd.udev.log_priority=3 vt.global_cursor_default=0 plymouth.use-simpledrm\n'),
+        (mountpoint / 'etc' / 'mkinitcpio.d' / 'linux.preset', '''
 # mkinitcpio preset file for the 'linux' package
 
 ALL_config="/etc/mkinitcpio.conf"
@@ -250,33 +343,32 @@ default_options="--splash /usr/share/systemd/bootctl/splash-arch.bmp"
 
 fallback_uki="/boot/EFI/Linux/arch-linux-fallback.efi"
 fallback_options="-S autodetect"
-''')
+'''),
+    ])
 
     # Add additional packages
     installation.add_additional_packages(['systemd-ukify', 'networkmanager', 'openssh', 'iwd', 'plymouth'])
 
-    # Install systemd-boot bootloader for a UEFI system
-    installation.add_bootloader(Bootloader.Systemd)
-
-    # Create EFI/Linux directory for UKIs
-    efi_linux_dir = mountpoint / 'boot' / 'EFI' / 'Linux'
-    efi_linux_dir.mkdir(parents=True, exist_ok=True)
-
     # Configure mkinitcpio hooks for Plymouth
+    # Without the plymouth-set-default-theme -R rebuild, the explicit
+    # mkinitcpio -P below is the only rebuild this script requests
     mkinitcpio_conf = mountpoint / 'etc' / 'mkinitcpio.conf'
     with open(mkinitcpio_conf, 'a') as f:
-        f.write('\nHOOKS=(base udev autodetect modconf kms plymouth block encrypt filesystems keyboard fsck)\n')
+        f.write(f'\nHOOKS=(base udev autodetect modconf kms plymouth block{encrypt_hook} filesystems keyboard fsck)\n')
         if driver:
             f.write(f'MODULES=({driver})\n')
 
-    # Set Plymouth default theme
-    installation.arch_chroot('plymouth-set-default-theme -R spinner')
+    # Configure Plymouth daemon with the spinner theme
+    # Writing plymouthd.conf directly replaces plymouth-set-default-theme -R,
+    # which would rebuild the initramfs just to set the same Theme= line
+    write_files([(mountpoint / 'etc' / 'plymouth' / 'plymouthd.conf', '[Daemon]\nTheme=spinner\nShowDelay=0\n')])
 
-    # Configure Plymouth daemon
-    plymouthd_conf = mountpoint / 'etc' / 'plymouth' / 'plymouthd.conf'
-    plymouthd_conf.parent.mkdir(parents=True, exist_ok=True)
-    with open(plymouthd_conf, 'w') as f:
-        f.write('[Daemon]\nTheme=spinner\nShowDelay=0\n')
+    # Install systemd-boot bootloader for a UEFI system
+    installation.add_bootloader(Bootloader.Systemd)
+
+    # Create EFI/Linux directory for UKIs
+    efi_linux_dir = mountpoint / 'boot' / 'EFI' / 'Linux'
+    efi_linux_dir.mkdir(parents=True, exist_ok=True)
 
     # Generate UKIs
     installation.arch_chroot('mkinitcpio -P')
@@ -296,11 +388,11 @@ editor no
     profile_handler.install_profile_config(installation, profile_config)
 
     # Create sudo user
-    user = User(sudo_user, Password(plaintext=sudo_password), True)
+    user = User(sudo_user, sudo_password, True)
     installation.create_users(user)
 
     # Set root password
-    root_user = User('root', Password(plaintext=root_password), False)
+    root_user = User('root', root_password, False)
     installation.set_user_password(root_user)
 
     # Enable services
@@ -311,37 +403,35 @@ editor no
     
     installation.setup_swap("zram")
     
-    # Create a swap file inside the encrypted root filesystem
-    # This provides swap space for memory-intensive tasks and is encrypted along with the root partition
+    # Create a swap file inside the root filesystem
+    # This provides swap space for memory-intensive tasks and is encrypted along with the root partition when encryption is enabled
+    # The file is allocated and formatted from the host through the mounted target, no chroot needed
     print("Creating swap file...")
-    swap_size = config["swap_size"]
-    installation.arch_chroot(f'fallocate -l {swap_size} /swapfile')
-    installation.arch_chroot('chmod 600 /swapfile')
-    installation.arch_chroot('mkswap /swapfile')
-    
+    swap_file = mountpoint / 'swapfile'
+    swap_file.touch(mode=0o600)
+    subprocess.run(['fallocate', '-l', config["swap_size"], swap_file], check=True)
+    subprocess.run(['mkswap', swap_file], check=True)
+
     # Set swap file priority to 5 to ensure it is used after zram
-    installation.arch_chroot('echo "/swapfile none swap pri=5 0 0" >> /etc/fstab')
+    with open(mountpoint / 'etc' / 'fstab', 'a') as f:
+        f.write('/swapfile none swap pri=5 0 0\n')
 
     # Copy configuration files
     config_source = Path('/tmp/archinstall')
     config_target = mountpoint / 'opt' / 'archinstall'
-    config_target.mkdir(parents=True, exist_ok=True)
-    shutil.copytree(str(config_source), str(config_target), dirs_exist_ok=True)
+    copy_tree(config_source, config_target)
     
-    # Make the post-install script executable within the new system
-    installation.arch_chroot('chmod +x /opt/archinstall/post_install.sh')
+    # Make the post-install script executable from the host, so the only
+    # chroot entry left for it is the one that runs it
+    post_install_script = config_target / 'post_install.sh'
+    post_install_script.chmod(post_install_script.stat().st_mode | 0o111)
 
 # Remove old Ubuntu entries, uncomment and rename if you want to clean up old boot entries in the UEFI boot meny.
 #print("\n--- Customizing EFI boot entry ---")
 #efiboot_output = subprocess.check_output(['efibootmgr', '-v']).decode()
-#lines = efiboot_output.splitlines()
 #
-#ubuntu_nums = []
-#for line in lines:
-#    if 'Ubuntu' in line:
-#        match = re.match(r'Boot([0-9A-F]{4})', line)
-#        if match:
-#            ubuntu_nums.append(match.group(1))
+## One pass over the whole output collects the numbers of all Ubuntu entries
+#ubuntu_nums = re.findall(r'^Boot([0-9A-F]{4})\*?\s.*Ubuntu', efiboot_output, re.MULTILINE)
 #
 #for boot_num in ubuntu_nums:
 #    subprocess.call(['efibootmgr', '--delete-bootnum', '--bootnum', boot_num])
@@ -351,7 +441,7 @@ editor no
 print("\n--- Running post-install script ---")
 command = [
     'arch-chroot',
-    str(mountpoint),
+    mountpoint,
     '/opt/archinstall/post_install.sh',
     sudo_user
 ]
@@ -361,14 +451,17 @@ try:
         command,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
-        text=True,
-        bufsize=1,
-        universal_newlines=True
+        bufsize=0,
     )
 
+    # Relay output in large raw chunks straight to our stdout, without per-line decoding
     if process.stdout:
-        for line in iter(process.stdout.readline, ''):
-            print(line, end='')
+        # Flush pending text output first so it is not reordered after the raw bytes
+        sys.stdout.flush()
+        fd = process.stdout.fileno()
+        while chunk := os.read(fd, 65536):
+            sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
 
     process.wait()
 